@@ -5,29 +5,75 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "fastmcp==0.4.1",
-#     "imessagedb==1.4.7",
 #     "phonenumbers==8.13.52",
+#     "psutil==7.2.2",
 # ]
 # ///
 
 from pathlib import Path
+import atexit
+import json
 import os
+import re
+import sqlite3
 import subprocess
-from typing import Dict, Any
+import sys
+import time
+from typing import Dict, Any, Iterator
 from fastmcp import FastMCP
-from datetime import datetime, timedelta
-import imessagedb
-import phonenumbers
-import contextlib
-import io
+from datetime import date, datetime, timedelta
+import psutil
+import functools
 
 # Initialize FastMCP server
-mcp = FastMCP("iMessage Query", dependencies=["imessagedb", "phonenumbers"])
+mcp = FastMCP("iMessage Query", dependencies=["phonenumbers", "psutil"])
 
 # Default to Messages database in user's Library
 DEFAULT_DB_PATH = Path.home() / "Library" / "Messages" / "chat.db"
 DB_PATH = Path(os.environ.get('SQLITE_DB_PATH', DEFAULT_DB_PATH))
 
+# Input that is already E.164 is used as-is instead of going through phonenumbers
+_E164_RE = re.compile(r"\+[1-9][0-9]{6,14}")
+
+# Messages stores dates as nanoseconds since 2001-01-01 UTC
+APPLE_EPOCH = 978307200
+
+# Messages for every chat the handle takes part in, restricted to [start, end).
+# Filtering and sorting on chat_message_join.message_date (Messages' copy of message.date)
+# lets SQLite seek each chat's date range through the built-in
+# chat_message_join_idx_message_date_id_chat_id (chat_id, message_date, message_id) index.
+_TRANSCRIPT_SQL = """
+    SELECT m.ROWID,
+           m.date,
+           CASE WHEN ? THEN datetime(m.date / 1000000000 + 978307200, 'unixepoch', 'localtime') END,
+           m.is_from_me,
+           m.text,
+           m.attributedBody,
+           m.cache_has_attachments
+    FROM chat_message_join cmj
+    JOIN message m ON m.ROWID = cmj.message_id
+    WHERE cmj.chat_id IN (
+        SELECT chat_id FROM chat_handle_join WHERE handle_id IN (
+            SELECT ROWID FROM handle WHERE id = ?
+        )
+    )
+    AND cmj.message_date >= ? AND cmj.message_date < ?
+    ORDER BY cmj.message_date, cmj.message_id
+    LIMIT ? OFFSET ?
+"""
+
+# Message IDs are bound as a single JSON array and expanded with json_each, so the
+# query has one fixed text (prepared once per connection) and no bound-parameter limit
+_ATTACHMENTS_SQL = """
+    SELECT maj.message_id, a.filename, a.mime_type
+    FROM attachment a
+    JOIN message_attachment_join maj ON maj.attachment_id = a.ROWID
+    WHERE maj.message_id IN (SELECT value FROM json_each(?)) AND a.filename IS NOT NULL
+"""
+
+# Rows are fetched and their attachments looked up in batches of this many messages
+_SQL_BATCH_SIZE = 900
+
 def check_full_disk_access() -> bool:
     """Check if the current application has Full Disk Access."""
     try:
@@ -143,6 +189,26 @@ def _validate_database_access() -> None:
         error_msg = _create_permission_error_message(app_name, bundle_id, auto_opened)
         raise PermissionError(error_msg)
 
+# Set once database access has been validated; cleared when SQLite reports a permission error
+_access_ok = False
+
+def _ensure_database_access() -> None:
+    """Validate database access on first use and skip the checks once it has succeeded.
+
+    Raises:
+        FileNotFoundError: If Messages database doesn't exist
+        PermissionError: If Full Disk Access permission is not granted
+    """
+    global _access_ok
+    if not _access_ok:
+        _validate_database_access()
+        _access_ok = True
+
+def _invalidate_database_access() -> None:
+    """Forget the cached access check so the next tool call validates again."""
+    global _access_ok
+    _access_ok = False
+
 # Known MCP client applications with their bundle IDs
 MCP_CLIENTS = {
     "Claude Desktop": "com.anthropic.claude",
@@ -159,70 +225,88 @@ TERMINAL_APPS = {
     "Hyper": "co.zeit.hyper"
 }
 
+# An MCP client name followed by its .app bundle, matched in one pass over a path or command line
+_MCP_CLIENT_RE = re.compile(r"(claude|cursor|visual studio code|code).*?\.app", re.IGNORECASE)
+_MCP_CLIENT_NAMES = {
+    "claude": "Claude Desktop",
+    "cursor": "Cursor",
+    "visual studio code": "VS Code",
+    "code": "VS Code",
+}
+
+def _match_mcp_client(text: str) -> str | None:
+    """Return the MCP client referenced by an executable path or command line, if any."""
+    match = _MCP_CLIENT_RE.search(text)
+    if match is None:
+        return None
+    return _MCP_CLIENT_NAMES[match.group(1).lower()]
+
 def _find_running_mcp_clients() -> tuple[str, str] | None:
     """Scan running processes for known MCP clients."""
+    found = None
     try:
-        result = subprocess.run(["ps", "aux"], capture_output=True, text=True)
-        if result.returncode != 0:
-            return None
-            
-        processes = result.stdout.lower()
-        
-        # Check for each known MCP client
-        if "claude" in processes and ".app" in processes:
-            return ("Claude Desktop", MCP_CLIENTS["Claude Desktop"])
-        elif "cursor" in processes and ".app" in processes:
-            return ("Cursor", MCP_CLIENTS["Cursor"])
-        elif ("visual studio code" in processes or "code" in processes) and ".app" in processes:
-            return ("VS Code", MCP_CLIENTS["VS Code"])
-            
-        return None
-    except:
-        return None
+        running = set()
+        for proc in psutil.process_iter(["name", "exe"]):
+            app_name = _match_mcp_client(f"{proc.info['exe'] or ''} {proc.info['name'] or ''}")
+            if app_name:
+                running.add(app_name)
+
+        # Check for each known MCP client, in priority order
+        for app_name in MCP_CLIENTS:
+            if app_name in running:
+                found = (app_name, MCP_CLIENTS[app_name])
+                break
+    except psutil.Error:
+        found = None
+    return found
+
+def _read_process_table() -> dict[int, tuple[int, str, str]]:
+    """Snapshot the process table with a single ps call.
+
+    Returns:
+        Mapping of pid to (ppid, process name, command line)
+    """
+    result = subprocess.run(
+        ["ps", "-Ao", "pid=,ppid=,comm=,command="],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        return {}
+
+    table = {}
+    for line in result.stdout.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) < 3:
+            continue
+        try:
+            pid, ppid = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        parts = fields[2].split(None, 1)
+        table[pid] = (ppid, parts[0], parts[1] if len(parts) > 1 else "")
+    return table
 
 def _walk_process_tree() -> tuple[str, str]:
     """Walk up the process tree to identify the parent application."""
     try:
-        parent_pid = os.getppid()
+        process_table = _read_process_table()
+        pid_to_check = os.getppid()
         fallback_name = ("unknown application", "")
         
         # Check up to 5 levels up the process tree
         for level in range(5):
-            if level == 0:
-                pid_to_check = parent_pid
-            else:
-                # Get parent process ID
-                result = subprocess.run([
-                    "ps", "-p", str(pid_to_check), "-o", "ppid="
-                ], capture_output=True, text=True)
-                if result.returncode != 0:
-                    break
-                try:
-                    pid_to_check = int(result.stdout.strip())
-                except ValueError:
-                    break
-            
-            # Get process name and command
-            result = subprocess.run([
-                "ps", "-p", str(pid_to_check), "-o", "comm=,command="
-            ], capture_output=True, text=True)
-            if result.returncode != 0 or not result.stdout.strip():
-                continue
-                
-            parts = result.stdout.strip().split(None, 1)
-            if len(parts) < 2:
+            if pid_to_check not in process_table:
+                break
+            parent_pid, app_name, command = process_table[pid_to_check]
+            pid_to_check = parent_pid
+            if not command:
                 continue
-                
-            app_name, command = parts[0], parts[1]
             
             # Check for MCP clients in command path
-            command_lower = command.lower()
-            if "claude" in command_lower and ".app" in command_lower:
-                return ("Claude Desktop", MCP_CLIENTS["Claude Desktop"])
-            elif "cursor" in command_lower and ".app" in command_lower:
-                return ("Cursor", MCP_CLIENTS["Cursor"])
-            elif ("visual studio code" in command_lower or "code" in command_lower) and ".app" in command_lower:
-                return ("VS Code", MCP_CLIENTS["VS Code"])
+            mcp_client = _match_mcp_client(command)
+            if mcp_client:
+                return (mcp_client, MCP_CLIENTS[mcp_client])
             
             # Check known applications by process name
             all_apps = {**MCP_CLIENTS, **TERMINAL_APPS}
@@ -237,6 +321,10 @@ def _walk_process_tree() -> tuple[str, str]:
     except:
         return ("unknown application", "")
 
+# Permission errors can fire repeatedly in a burst, so reuse a recent lookup
+_PARENT_APP_TTL = 5.0
+_parent_app_cache: tuple[float, tuple[str, str]] | None = None
+
 def get_parent_app_name() -> tuple[str, str]:
     """Get the name and bundle ID of the parent application (MCP client or terminal).
     
@@ -244,52 +332,191 @@ def get_parent_app_name() -> tuple[str, str]:
         Tuple of (app_name, bundle_id) where app_name is human-readable 
         and bundle_id is the macOS bundle identifier.
     """
-    # First, try to find running MCP clients directly
-    mcp_client = _find_running_mcp_clients()
-    if mcp_client:
-        return mcp_client
-    
-    # Fallback: Walk up the process tree
-    return _walk_process_tree()
+    global _parent_app_cache
+
+    now = time.monotonic()
+    if _parent_app_cache is not None and now - _parent_app_cache[0] < _PARENT_APP_TTL:
+        return _parent_app_cache[1]
+
+    # First, try to find running MCP clients directly, then fall back to walking up the process tree
+    parent_app = _find_running_mcp_clients() or _walk_process_tree()
+    _parent_app_cache = (now, parent_app)
+    return parent_app
 
 
 class DatabaseContext:
-    """Singleton context for managing database connections across tools."""
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(DatabaseContext, cls).__new__(cls)
-            cls._instance.db_path = DB_PATH
-            cls._instance._db = None
-        return cls._instance
-
-    def get_connection(self):
-        """Get an imessagedb connection from the context."""
-        if self._db is None:
-            self._db = imessagedb.DB(str(self.db_path))
-        return self._db
-
-class MessageDBConnection:
-    """Context manager for database connections."""
-    def __init__(self):
-        self.db_context = DatabaseContext()
-        self.db = None
-
-    def __enter__(self):
-        self.db = self.db_context.get_connection()
-        return self.db
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        # No need to close imessagedb connection
-        # Parameters are required by context manager protocol but unused
-        del exc_type, exc_val, exc_tb
+    """Shared context for managing database connections across tools."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        # Opened on first use and kept for the life of the server. FastMCP runs
+        # sync tools on the event-loop thread, so calls never overlap.
+        self._conn = None
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the shared read-only sqlite3 connection, opening it on first use."""
+        if self._conn is None:
+            self._conn = self._open_readonly_connection()
+        return self._conn
+
+    def close(self) -> None:
+        """Close the shared connection if it has been opened."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _open_readonly_connection(self) -> sqlite3.Connection:
+        """Open a read-only sqlite3 connection to the Messages database."""
+        uri = f"{self.db_path.absolute().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        # immutable=1 is deliberately not used: Messages keeps writing to the WAL
+        # while we read, and immutable mode would hide those recent messages
+        conn.executescript(
+            "PRAGMA query_only=1;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA cache_size=-65536;"
+            "PRAGMA mmap_size=268435456;"
+        )
+        return conn
+
+# Created once at import; every tool call reuses its connection
+_DB_CTX = DatabaseContext(DB_PATH)
+atexit.register(_DB_CTX.close)
+
+def _to_apple_time(day: date) -> int:
+    """Convert local midnight at the start of a day to a Messages database timestamp.
+
+    Days beyond what the platform or a 64-bit SQLite integer can represent are clamped,
+    which still places them before or after every stored message.
+    """
+    try:
+        midnight = datetime.combine(day, datetime.min.time()).timestamp()
+    except (OverflowError, OSError, ValueError):
+        return -sys.maxsize if day.year < 1970 else sys.maxsize
+    apple_time = (int(midnight) - APPLE_EPOCH) * 1_000_000_000
+    return max(-sys.maxsize, min(apple_time, sys.maxsize))
+
+# In the typedstream archive the text follows the NSString class name, this header and a
+# length prefix: one byte, or 0x81/0x82 followed by a 2/4-byte little-endian length
+_NSSTRING_HEADER = b'NSString\x01\x94\x84\x01+'
+
+def _decode_attributed_body(attributed_body: bytes) -> str | None:
+    """Pull the plain text out of an NSAttributedString typedstream blob."""
+    start = attributed_body.find(_NSSTRING_HEADER)
+    if start != -1:
+        pos = start + len(_NSSTRING_HEADER)
+        length = attributed_body[pos] if pos < len(attributed_body) else 0
+        pos += 1
+        if length == 0x81:
+            length = int.from_bytes(attributed_body[pos:pos + 2], 'little')
+            pos += 2
+        elif length == 0x82:
+            length = int.from_bytes(attributed_body[pos:pos + 4], 'little')
+            pos += 4
+        text = attributed_body[pos:pos + length]
+        if text and len(text) == length:
+            return text.decode('utf-8', errors='replace')
+
+    # Unrecognised layout: fall back to heuristic splitting on known markers
+    return _split_attributed_body(attributed_body)
+
+def _split_attributed_body(attributed_body: bytes) -> str | None:
+    """Heuristically extract text from an attributedBody blob by splitting on known markers."""
+    try:
+        text = attributed_body.split(b'NSNumber')[0]
+        text = text.split(b'NSString')[1]
+        text = text.split(b'NSDictionary')[0]
+        text = text[6:-12]
+        for separator in (b'\x01', b'\x02', b'\x00'):
+            if separator in text:
+                text = text.split(separator)[1]
+        if b'\x86' in text:
+            text = text.split(b'\x86')[0]
+        return text.decode('utf-8', errors='replace')
+    except IndexError:
+        return None
+
+def _extract_message_text(text: str | None, attributed_body: bytes | None) -> str | None:
+    """Return the message text, falling back to attributedBody when the text column is empty."""
+    # Newer macOS versions often leave the text column empty and only fill attributedBody
+    if text in (None, '', ' ') and attributed_body is not None:
+        return _decode_attributed_body(attributed_body)
+    return text
+
+def _fetch_attachments(conn: sqlite3.Connection, message_ids: list[int]) -> dict[int, list[Dict[str, Any]]]:
+    """Fetch attachment metadata for a batch of messages with a single query.
+
+    Returns:
+        Mapping of message rowid to that message's attachments
+    """
+    attachments = {}
+    if not message_ids:
+        return attachments
+
+    rows = conn.execute(_ATTACHMENTS_SQL, (json.dumps(message_ids),))
+    for message_id, filename, mime_type in rows:
+        file_path = os.path.expanduser(filename)
+        attachments.setdefault(message_id, []).append({
+            "mime_type": mime_type,
+            "filename": filename,
+            "file_path": file_path,
+            "is_missing": not os.path.exists(file_path)
+        })
+    return attachments
+
+def _iter_messages(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> Iterator[Dict[str, Any]]:
+    """Yield transcript rows as the dictionaries returned to the client."""
+    while rows := cursor.fetchmany(_SQL_BATCH_SIZE):
+        attachments = _fetch_attachments(conn, [row[0] for row in rows if row[-1]])
+        for rowid, date_apple_ns, date_str, is_from_me, text, attributed_body, _ in rows:
+            message_attachments = attachments.get(rowid, [])
+            message = {"text": _extract_message_text(text, attributed_body)}
+            # date is only selected when format_dates is set
+            if date_str is not None:
+                message["date"] = date_str
+            message["date_apple_ns"] = date_apple_ns
+            message["is_from_me"] = is_from_me
+            message["has_attachments"] = bool(message_attachments)
+            message["attachments"] = message_attachments
+            yield message
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_phone(phone_number: str) -> str:
+    """Validate a phone number and format it as E.164.
+
+    Args:
+        phone_number: Phone number in any format; US is assumed when no region is given
+
+    Returns:
+        The phone number in E.164 format
+
+    Raises:
+        ValueError: If the phone number is invalid
+    """
+    if _E164_RE.fullmatch(phone_number):
+        return phone_number
+
+    # Imported on first use: phonenumbers loads sizeable region metadata
+    import phonenumbers
+
+    try:
+        # Parse assuming US number if no region provided
+        parsed_number = phonenumbers.parse(phone_number, "US")
+        if not phonenumbers.is_valid_number(parsed_number):
+            raise ValueError(f"Invalid phone number: {phone_number}")
+        # Format to E.164 format
+        return phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
+    except phonenumbers.NumberParseException as e:
+        raise ValueError(f"Invalid phone number format: {e}")
 
 @mcp.tool()
 def get_chat_transcript(
     phone_number: str,
     start_date: str = None,
-    end_date: str = None
+    end_date: str = None,
+    limit: int = None,
+    offset: int = 0,
+    format_dates: bool = True
 ) -> Dict[str, Any]:
     """Get chat transcript for a specific phone number within a date range.
 
@@ -297,86 +524,85 @@ def get_chat_transcript(
         phone_number: Phone number to get transcript for (E.164 format preferred)
         start_date: Optional start date in ISO format (YYYY-MM-DD)
         end_date: Optional end date in ISO format (YYYY-MM-DD)
+        limit: Optional maximum number of messages to return, for paging through long transcripts
+        offset: Number of messages to skip before the first one returned
+        format_dates: Include a local-time "date" string with each message; every message
+            always carries its raw "date_apple_ns" (nanoseconds since 2001-01-01 UTC)
 
     Returns:
-        Dictionary containing the chat transcript data
+        Dictionary containing the chat transcript data: "messages", "total_count" (the
+        number of messages in this page) and "has_more" (whether later messages remain)
 
     Raises:
-        ValueError: If the phone number is invalid
+        ValueError: If the phone number, date range or paging values are invalid
     """
     # Validate and format the phone number
+    phone_number = _normalize_phone(phone_number)
+
+    # Set default date range to last 7 days if not specified
+    if not start_date and not end_date:
+        end_day = date.today()
+        start_day = end_day - timedelta(days=7)
+        start_date = start_day.isoformat()
+        end_date = end_day.isoformat()
+
+    # Reject bad dates before touching the database; only plain YYYY-MM-DD is accepted
     try:
-        # Parse assuming US number if no region provided
-        parsed_number = phonenumbers.parse(phone_number, "US")
-        if not phonenumbers.is_valid_number(parsed_number):
-            raise ValueError(f"Invalid phone number: {phone_number}")
-        # Format to E.164 format
-        phone_number = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
-    except phonenumbers.NumberParseException as e:
-        raise ValueError(f"Invalid phone number format: {e}")
+        start_day = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+        end_day = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+    except ValueError as e:
+        raise ValueError(f"Invalid date format, expected YYYY-MM-DD: {e}")
+    if start_day and end_day and start_day > end_day:
+        raise ValueError(f"start_date {start_date} is after end_date {end_date}")
+
+    if limit is not None and limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+    if offset < 0:
+        raise ValueError(f"offset must not be negative, got {offset}")
+
+    # Convert the inclusive date range to database timestamps so SQLite does the filtering
+    start_time = _to_apple_time(start_day) if start_day else 0
+    if end_day and end_day < date.max:
+        end_time = _to_apple_time(end_day + timedelta(days=1))
+    else:
+        end_time = sys.maxsize
 
     # Validate database access and permissions
-    _validate_database_access()
+    _ensure_database_access()
 
-    # Suppress stdout to hide progress bars
-    with contextlib.redirect_stdout(io.StringIO()):
-        try:
-            with MessageDBConnection() as db:
-                # Create Messages object for the phone number
-                messages = db.Messages("person", phone_number, numbers=[phone_number])
-
-                # Set default date range to last 7 days if not specified
-                if not start_date and not end_date:
-                    end_dt = datetime.now()
-                    start_dt = end_dt - timedelta(days=7)
-                    start_date = start_dt.strftime("%Y-%m-%d")
-                    end_date = end_dt.strftime("%Y-%m-%d")
-
-                # Filter messages by date if specified
-                filtered_messages = []
-                for msg in messages.message_list:
-                    msg_date = datetime.strptime(msg.date[:10], "%Y-%m-%d")
-
-                    if start_date:
-                        start_dt = datetime.fromisoformat(start_date)
-                        if msg_date < start_dt:
-                            continue
-
-                    if end_date:
-                        end_dt = datetime.fromisoformat(end_date)
-                        if msg_date > end_dt:
-                            continue
-
-                    filtered_messages.append({
-                        "text": msg.text,
-                        "date": msg.date,
-                        "is_from_me": msg.is_from_me,
-                        "has_attachments": bool(msg.attachments),
-                        "attachments": [
-                            {
-                                "mime_type": att.mime_type if hasattr(att, 'mime_type') else None,
-                                "filename": att.filename if hasattr(att, 'filename') else None,
-                                "file_path": att.original_path if hasattr(att, 'original_path') else None,
-                                "is_missing": att.missing if hasattr(att, 'missing') else False
-                            } for att in msg.attachments if isinstance(att, object)
-                        ] if msg.attachments else []
-                    })
-
-                return {
-                    "messages": filtered_messages,
-                    "total_count": len(filtered_messages)
-                }
-        except Exception as e:
-            # Check if this is a permission-related database error
-            error_str = str(e).lower()
-            if "unable to open database file" in error_str or "operation not permitted" in error_str:
-                app_name, bundle_id = get_parent_app_name()
-                error_msg = _create_permission_error_message(app_name, bundle_id, False)
-                error_msg += f"\n\nOriginal error: {e}"
-                raise PermissionError(error_msg)
-            else:
-                # Re-raise other exceptions as-is
-                raise
+    try:
+        # Fetch one extra row to tell whether another page follows; a negative LIMIT means no limit
+        page_size = limit + 1 if limit is not None else -1
+        conn = _DB_CTX.connection()
+        cursor = conn.execute(
+            _TRANSCRIPT_SQL,
+            (format_dates, phone_number, start_time, end_time, page_size, offset),
+        )
+        # FastMCP tools return a single result, so stream rows straight into the list
+        filtered_messages = list(_iter_messages(conn, cursor))
+
+        has_more = limit is not None and len(filtered_messages) > limit
+        if has_more:
+            del filtered_messages[limit:]
+
+        return {
+            "messages": filtered_messages,
+            "total_count": len(filtered_messages),
+            "has_more": has_more
+        }
+    except Exception as e:
+        # Check if this is a permission-related database error
+        error_str = str(e).lower()
+        if "unable to open database file" in error_str or "operation not permitted" in error_str:
+            # Access was revoked or never really granted, so validate again next time
+            _invalidate_database_access()
+            app_name, bundle_id = get_parent_app_name()
+            error_msg = _create_permission_error_message(app_name, bundle_id, False)
+            error_msg += f"\n\nOriginal error: {e}"
+            raise PermissionError(error_msg)
+        else:
+            # Re-raise other exceptions as-is
+            raise
 
 # Run the server
 if __name__ == "__main__":